@@ -5,23 +5,37 @@
 
 
 # stdlib
+import atexit
+import csv
+import json
 import re
 import os
+import shutil
 import time
 import sys
-from csv import DictReader
-from urllib.request import urlopen, urlretrieve, HTTPError
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 import getpass
 
 # additional dependencies
 import click
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.exceptions import HTTPError as Urllib3Error
+from urllib3.util.retry import Retry
+
+
+TRACK_RE = re.compile(r"^[a-z]{2,}\d{2}[a-z]+$")
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([a-z0-9#]+)"')
+ROLE_RE = re.compile(r'<a href="/(\w+)/(\w+)">(.+)</a>')
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-')
 
 
 # unused
 def validate_track_id(track):
-    if re.match(r"^[a-z]{2,}\d{2}[a-z]+$", track):
+    if TRACK_RE.match(track):
         return track
     else:
         raise click.BadParameter("Last parameter needs to be the conference track ID from PCS (e.g. 'chi23b')")
@@ -36,6 +50,18 @@ PCS_SPREADSHEET_URL_PREFIX = "https://new.precisionconference.com/"
 PCS_SPREADSHEET_URL_SUFFIX = "/pubchair/csv/camera"
 LIST_FILE_SUFFIX = "_camera_ready.csv"
 FIELDS_FILE_SUFFIX = "_fields.csv"
+STATE_FILE_SUFFIX = "_state.json"
+STATE_MAX_AGE = 24 * 60 * 60  # seconds after which we ask the server again whether a file changed
+PARTIAL_FILE_SUFFIX = ".part"
+POOL_MAXSIZE = 32  # connections kept open per host
+GUESS_FIELDS_MAX_ROWS = 200  # submissions to look at for --guess_fields
+NON_UPLOAD_HOSTS = {"doi.org", "dx.doi.org"}  # URLs in the CSV that don't point to uploaded files
+DOWNLOAD_ATTEMPTS = 3  # per file, for connections that break while reading the body
+LINK_EXPIRED = object()  # returned by download_file() if we need a fresh camera_ready.csv
+# requests asks for gzip by default. we want the files exactly as uploaded, so that Content-Length and
+# byte ranges match the local file
+FILE_REQUEST_HEADERS = {'Accept-Encoding': 'identity'}
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # bytes per read/write - large chunks keep the Python overhead low for big videos
 
 
 def file_is_current(file_path, max_seconds=300):
@@ -44,18 +70,38 @@ def file_is_current(file_path, max_seconds=300):
     return (current_time - file_mtime) < max_seconds
 
 
-def get_available_tracks(user, password, print_them=False):
+# We use one session for logging in and for all downloads, so that TCP/TLS connections to PCS are reused
+# and we only need to log in once per run.
+
+def login(user, password, session=None):
+    # pass an existing session to log in again (e.g., after the PCS session expired)
+    if session is None:
+        session = requests.Session()
+        # retry failed connections and temporary server errors with exponential backoff
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=['GET', 'HEAD'])
+        session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=POOL_MAXSIZE, max_retries=retry))
+    r = session.get(PCS_LOGIN_URL)
+    csrf_token = CSRF_RE.search(r.text).groups()[0]
+    r = session.post(PCS_LOGIN_URL, data={'username': user, 'password': password, 'csrf_token': csrf_token})
+    if not r.ok or is_login_page(r):  # PCS shows the login form again if the credentials are wrong
+        print("Login to PCS failed - please check user name and password")
+        sys.exit(1)
+    return session
+
+
+def is_login_page(response):
+    # PCS redirects to the login form if we are not (or no longer) logged in
+    return response.url.startswith(PCS_LOGIN_URL)
+
+
+def get_available_tracks(session, print_them=False):
     print("Getting list of tracks ... ")
-    pcs_session = requests.Session()
-    r = pcs_session.get(PCS_LOGIN_URL)
-    csrf_token = re.search(r'name="csrf_token" type="hidden" value="([a-z0-9#]+)"', r.text).groups()[0]
-    r = pcs_session.post(PCS_LOGIN_URL, data={'username': user, 'password': password, 'csrf_token': csrf_token})
-    r = pcs_session.get(PCS_TRACK_LIST_URL)
+    r = session.get(PCS_TRACK_LIST_URL)
     roles = r.json()['data']
     available_tracks = {}
     for role in roles:
         title = role[0]
-        match = re.match(r'<a href="/(\w+)/(\w+)">(.+)</a>', role[3])
+        match = ROLE_RE.match(role[3])
         track_id = match.group(1)
         role_id = match.group(2)
         track_name = match.group(3)
@@ -66,25 +112,35 @@ def get_available_tracks(user, password, print_them=False):
     return available_tracks
 
 
+def is_csv_response(response):
+    return (response.status_code != 401 and not is_login_page(response)
+            and "text/html" not in response.headers.get("Content-Type", ""))
+
+
 # We need to re-download the csv file every few hours because the download links for all media files 
 # expire after some time. They are regenerated by PCS on download of the camera_ready.csv file.
 # The download loop automates this.
 
-def get_camera_ready_csv(track_id, user, password, overwrite=True):
-    # get current data from PCS
+def get_camera_ready_csv(session, track_id, user, password, overwrite=True, max_age=5 * 60):
+    # get current data from PCS. max_age=0 always downloads a fresh file (e.g., if download links expired)
     list_file = f"{track_id}{LIST_FILE_SUFFIX}"
     if overwrite is False and os.path.exists(list_file):
         print("file already exists - skipping download")
         return
-    if os.path.exists(list_file) and file_is_current(list_file, 5 * 60):
-        print("file already downloaded less than five minutes ago - skipping download")
+    if max_age > 0 and os.path.exists(list_file) and file_is_current(list_file, max_age):
+        print(f"file already downloaded less than {max_age // 60} minutes ago - skipping download")
         return
     print("Downloading camera_ready.csv ... ")
-    pcs_session = requests.Session()
-    r = pcs_session.get(PCS_LOGIN_URL)
-    csrf_token = re.search(r'name="csrf_token" type="hidden" value="([a-z0-9#]+)"', r.text).groups()[0]
-    r = pcs_session.post(PCS_LOGIN_URL, data={'username': user, 'password': password, 'csrf_token': csrf_token})
-    r = pcs_session.get(PCS_SPREADSHEET_URL_PREFIX + track_id + PCS_SPREADSHEET_URL_SUFFIX)
+    csv_url = PCS_SPREADSHEET_URL_PREFIX + track_id + PCS_SPREADSHEET_URL_SUFFIX
+    r = session.get(csv_url)
+    if not is_csv_response(r):  # PCS session expired
+        print("Logging in again ... ")
+        login(user, password, session)
+        r = session.get(csv_url)
+    r.raise_for_status()
+    if not is_csv_response(r):  # don't overwrite the last good CSV with an HTML page
+        print(f"PCS did not return a CSV file for track '{track_id}' - do you have access to it?")
+        sys.exit(1)
     with open(list_file, "wb") as fd:
         fd.write(r.content)
     print("done.")
@@ -93,7 +149,7 @@ def get_camera_ready_csv(track_id, user, password, overwrite=True):
 def get_filetypes(typefile):
     try:
         fd = open(typefile, "r")
-        dr = DictReader(fd)
+        dr = csv.DictReader(fd)
         filetypes = []
         for dic in dr:
             filetypes.append(dic)
@@ -103,107 +159,302 @@ def get_filetypes(typefile):
         sys.exit(1)
 
 
-def download_file(paper_id, url, filename, overwrite="modified"):
+def read_camera_ready_csv(track_id):
+    # plain csv.reader instead of DictReader: rows are lists, so we don't build a dict for every submission.
+    # returns {column name: index} and all rows. like DictReader, we skip empty lines and pad short rows
+    list_file = f"{track_id}{LIST_FILE_SUFFIX}"
+    with open(list_file, encoding='utf-8-sig') as fd:  # CSV has BOM
+        reader = csv.reader(fd)
+        header = next(reader, None)
+        if not header or 'Paper ID' not in header or 'Title' not in header:
+            print(f"{list_file} does not look like a camera-ready spreadsheet from PCS")
+            sys.exit(1)
+        columns = {name: col for col, name in enumerate(header)}
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < len(header):
+                row += [''] * (len(header) - len(row))
+            rows.append(row)
+    return columns, rows
+
+
+def local_file_size(filename):
+    # one stat() call instead of os.path.exists() + os.stat()
+    try:
+        return os.path.getsize(filename)
+    except FileNotFoundError:
+        return None
+
+
+# To avoid one HEAD request per file on every run, we remember ETag and size of each file
+# that we downloaded or checked recently in {track_id}_state.json.
+# filename: {'etag': ..., 'size': ..., 'ts': time of last download/check}
+# filename.part: {'validator': ETag or Last-Modified of the interrupted download, for If-Range}
+DOWNLOAD_STATE = {}
+
+
+def load_download_state(track_id):
+    state_file = f"{track_id}{STATE_FILE_SUFFIX}"
+    try:
+        with open(state_file) as fd:
+            DOWNLOAD_STATE.update(json.load(fd))
+    except FileNotFoundError:
+        pass
+    except (ValueError, OSError) as e:  # the state is only a cache - start over if it's unreadable
+        print(f"Ignoring unreadable {state_file} ({e})")
+    atexit.register(save_download_state, state_file)
+
+
+def save_download_state(state_file):
+    # write to a temporary file first, so that an interrupted write can't leave a broken state file behind
+    with open(state_file + ".tmp", "w") as fd:
+        json.dump(DOWNLOAD_STATE, fd, indent=1)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def remote_file_unchanged(session, url, filename, file_size, max_age=STATE_MAX_AGE):
+    # ask the server whether the local copy is still current - without downloading the file.
+    state = DOWNLOAD_STATE.get(filename)
+    if state and state['size'] != file_size:
+        state = None  # local file has been changed since, don't trust the old state
+    if state and time.time() - state['ts'] < max_age:
+        return True
+    # if we know the ETag from the last download, the server can answer with "304 Not Modified"
+    headers = dict(FILE_REQUEST_HEADERS)
+    if state and state['etag']:
+        headers['If-None-Match'] = state['etag']
+    r = session.head(url, headers=headers, timeout=10, allow_redirects=True)
+    if not r.ok and r.status_code != 304:
+        # some servers (e.g., pre-signed S3 URLs) only accept GET - only read the header in this case
+        r = session.get(url, headers=headers, stream=True, timeout=10)
+        r.close()
+    if r.status_code == 304 and state:  # we sent the ETag from our state and it still matches
+        state['ts'] = time.time()
+        return True
+    r.raise_for_status()
+    if state and state['etag'] and r.headers.get("ETag") != state['etag']:
+        return False  # file was replaced on the server, even if the size happens to be the same
+    if r.headers.get("Content-Encoding", "identity") != "identity":
+        # server compressed the body anyway, so Content-Length can't be compared with the local file.
+        # the ETag (if any) was already found to be unchanged above
+        return bool(state and state['etag'])
+    content_length = r.headers.get("Content-Length")
+    if content_length is None:  # e.g., chunked transfer - we can't tell, so download again
+        return False
+    if int(content_length) != file_size:
+        return False
+    DOWNLOAD_STATE[filename] = {'etag': r.headers.get("ETag"), 'size': file_size, 'ts': time.time()}
+    return True
+
+
+def range_validator(response):
+    # value for If-Range when resuming this download later. weak ETags are not allowed there
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None  # ranges would refer to the encoded data, but we write decoded data - don't resume
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def range_starts_at(response, start):
+    # "Content-Range: bytes 1000-1999/2000"
+    match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+    return match is not None and int(match.group(1)) == start
+
+
+def file_needs_download(session, url, filename, overwrite="modified", max_age=STATE_MAX_AGE):
+    # avoid unnecessary downloads
+    file_size = local_file_size(filename) if overwrite != "all" else None
+    if file_size is None:
+        return True
+    if overwrite == "none":
+        return False
+    try:
+        return not remote_file_unchanged(session, url, filename, file_size, max_age)  # only download if file changed
+    except (ValueError, requests.RequestException):
+        return True  # let download_file() try (and report the error)
+
+
+def fetch_file(session, url, filename):
+    # returns True if the file was downloaded completely, False if the download ended early,
+    # and LINK_EXPIRED if PCS rejected the link. raises requests/urllib3 errors for everything else
+    # download into a .part file first. if a previous download was interrupted, only request the missing bytes.
+    # If-Range makes sure that the server sends the whole file instead if it has changed in the meantime.
+    partial_file = filename + PARTIAL_FILE_SUFFIX
+    start = local_file_size(partial_file) or 0
+    validator = DOWNLOAD_STATE.get(partial_file, {}).get('validator')
+    headers = dict(FILE_REQUEST_HEADERS)
+    if start > 0 and validator:
+        headers.update({'Range': f'bytes={start}-', 'If-Range': validator})
+    else:
+        start = 0  # we can't tell whether the partial file belongs to the current version
+    doc = session.get(url, headers=headers, stream=True, timeout=10)
+    if doc.status_code == 416 or (doc.status_code == 206 and not range_starts_at(doc, start)):
+        # range not satisfiable, or not the range we asked for - start over
+        doc.close()
+        start = 0
+        doc = session.get(url, headers=FILE_REQUEST_HEADERS, stream=True, timeout=10)
+    if doc.status_code in (401, 403):  # download links from PCS expire after some time
+        doc.close()
+        tqdm.write(f"   >... link for {filename} expired")
+        return LINK_EXPIRED
+    doc.raise_for_status()
+    if doc.status_code != 206:  # server ignored the range request (or file changed) and sends the whole file
+        start = 0
+        DOWNLOAD_STATE[partial_file] = {'validator': range_validator(doc)}
+    content_length = doc.headers.get("Content-Length")
+    doc_size = int(content_length) if content_length else None  # e.g., missing for chunked transfer
+    doc.raw.decode_content = True  # like iter_content(), undo any Content-Encoding
+    with open(partial_file, 'ab' if start > 0 else 'wb') as fd:
+        #print(f" ({doc_size/1000000.0:.2f} MB)")
+        # tqdm.wrapattr() updates the progress bar on every fd.write()
+        with tqdm.wrapattr(fd, "write", initial=start, total=start + doc_size if doc_size is not None else None, leave=False) as out:
+            shutil.copyfileobj(doc.raw, out, length=DOWNLOAD_CHUNK_SIZE)
+    # compare the bytes received (before decoding) with Content-Length, which refers to the encoded body
+    if doc_size is not None and doc.raw.tell() != doc_size:
+        # connection ended early (urllib3 does not always complain) - keep the .part file for resuming
+        tqdm.write(f"   >... {filename} incomplete")
+        return False
+    os.replace(partial_file, filename)
+    DOWNLOAD_STATE.pop(partial_file, None)
+    DOWNLOAD_STATE[filename] = {'etag': doc.headers.get("ETag"), 'size': local_file_size(filename), 'ts': time.time()}
+    return True
+
+
+def download_file(session, paper_id, url, filename, overwrite="modified"):
     try:
-        doc = None
-        # avoid unnecessary downloads
-        if overwrite == "none":
-            if os.path.exists(filename):  # only download if file changed
-                tqdm.write("   >... already downloaded")
-                return True
-        elif overwrite == "modified":
-            doc = urlopen(url, timeout=10)
-            doc_size = int(doc.getheader("Content-Length"))
-            if os.path.exists(filename):  # only download if file changed
-                file_size = os.stat(filename).st_size
-                if file_size == doc_size:
-                    tqdm.write("   >... already downloaded")
-                    return True
-        # ok, we want to download the file. make request if not already done
-        if not doc:
-            doc = urlopen(url, timeout=10)
-            doc_size = int(doc.getheader("Content-Length"))
-        with open(filename, 'wb') as fd:
-            #print(f" ({doc_size/1000000.0:.2f} MB)")
-            progress_bar = tqdm(total=doc_size, unit='iB', unit_scale=True, leave=False)
-            while True:
-                data = doc.read(1024*100)
-                if not data:
-                    break
-                fd.write(data)
-                progress_bar.update(len(data))
-            progress_bar.close()
+        if not file_needs_download(session, url, filename, overwrite):
+            tqdm.write(f"   >... {filename} already downloaded")
             return True
-    except (ValueError, HTTPError) as e:
-        tqdm.write("   >... file not found on server")
-        print(e)
+        # urllib3 only retries until the response headers have arrived. if the connection breaks
+        # while we read the body, we try again and continue where we left off (see .part file)
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            if attempt > 0:
+                tqdm.write(f"   >... resuming {filename}")
+                time.sleep(2 ** attempt)
+            try:
+                result = fetch_file(session, url, filename)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, Urllib3Error) as e:
+                tqdm.write(f"   >... {filename}: {e}")
+                result = False
+            if result is not False:
+                return result
+        return False
+    except (ValueError, TypeError, requests.RequestException, Urllib3Error) as e:
+        tqdm.write(f"   >... {filename} not found on server")
+        tqdm.write(str(e))
         return False
 
 
 # overwrite: 
 # "all" download files regardless of whether they already exist
-# "modified" get HTTP header for each file and only downloade existing files if local file size is different than server file size.
+# "modified" get HTTP header for each file (HEAD request) and only downloade existing files if local file size is different than server file size
+#            or if the ETag from the last download does not match anymore. Files downloaded/checked less than STATE_MAX_AGE (24 h) ago
+#            are not checked again, unless --recheck is given.
 # "none" only download files that do not already exist locally (this misses files that have been modified recently but is faster than checking file sizes
 
-def download_files(track_id, filetypes, start_index=0, overwrite="modified"):
-    for filetype in filetypes:
-        try:
-            os.makedirs(f"{track_id}_{filetype['directory']}")
-        except FileExistsError:
-            print(f"directory '{track_id}_{filetype['directory']}' already exists, writing into it")
+# only_files: if given, only download these files (e.g., those whose links expired in the previous round)
 
-    fd = open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig')  # CSV has BOM
-    submissions = list(DictReader(fd))  # load in memory so that we get the line count
-    for idx, submission in enumerate(tqdm(submissions, desc="Submissions processed", leave=False)):
-        tqdm.write(f"[{idx}] Paper: {submission['Paper ID']} ({submission['Title']})")
+def download_files(session, track_id, filetypes, start_index=0, overwrite="modified", workers=4, max_age=STATE_MAX_AGE,
+                   only_files=None):
+    columns, rows = read_camera_ready_csv(track_id)
+    paper_id_col = columns['Paper ID']
+    title_col = columns['Title']
+    # look up the filetype properties (and their columns) once instead of once per submission
+    targets = []  # (description, column, directory, suffix)
+    for filetype in filetypes:
+        directory = f"{track_id}_{filetype['directory']}"
+        os.makedirs(directory, exist_ok=True)
+        if filetype['pcs_field'] in columns:
+            targets.append((filetype['description'], columns[filetype['pcs_field']], directory, filetype['suffix']))
+        else:
+            tqdm.write(f"   >... field {filetype['pcs_field']} not in CSV")
+    # collect all files first so that the downloads can run in parallel
+    tasks = []  # (submission index, paper_id, url, filename)
+    for idx, row in enumerate(rows):
+        paper_id = row[paper_id_col]
+        tqdm.write(f"[{idx}] Paper: {paper_id} ({row[title_col]})")
         if idx < start_index:
             tqdm.write("    skipping")
             continue
-        for filetype in filetypes:
+        for description, col, directory, suffix in targets:
+            url = row[col]
+            filename = f"{directory}/{paper_id}{suffix}"
+            if only_files is not None and filename not in only_files:
+                continue
+            if len(url) > 1:
+                tqdm.write(f"    Retrieving '{description}'")
+                tasks.append((idx, paper_id, url, filename))
+            else:
+                tqdm.write(f"   >... '{description}' not submitted")
+
+    # download links may point to different hosts (e.g., CDNs). keep the downloads from one host together
+    # so that its pooled connections are reused instead of being evicted by requests to other hosts
+    tasks.sort(key=lambda task: urlparse(task[2]).netloc)
+    if overwrite != "all":
+        # check all files first (HEAD requests are cheap, so we can run many in parallel)
+        # and only hand the files that really need downloading to the download workers
+        with ThreadPoolExecutor(max_workers=POOL_MAXSIZE) as executor:
+            checks = executor.map(lambda task: file_needs_download(session, task[2], task[3], overwrite, max_age), tasks)
             try:
-                if len(submission[filetype['pcs_field']]) > 1:
-                    tqdm.write(f"    Retrieving '{filetype['description']}'")
-                    paper_id = submission['Paper ID']
-                    filename = f"{track_id}_{filetype['directory']}/{paper_id}{filetype['suffix']}"
-                    url = submission[filetype['pcs_field']]
-                    if download_file(paper_id, url, filename, overwrite):
-                        pass 
-                        #print("done")
-                    else:
-                        tqdm.write("failed")
-                        return idx
-                else:
-                    tqdm.write(f"   >... '{filetype['description']}' not submitted")
-            except KeyError:
-                tqdm.write(f"   >... field {filetype['pcs_field']} not in CSV")
-    fd.close()
+                needed = list(tqdm(checks, total=len(tasks), desc="Files checked", leave=False))
+            except KeyboardInterrupt:
+                executor.shutdown(cancel_futures=True)  # don't wait for all queued checks
+                raise
+        for task, needs_download in zip(tasks, needed):
+            if not needs_download:
+                tqdm.write(f"   >... {task[3]} already downloaded")
+        tasks = [task for task, needs_download in zip(tasks, needed) if needs_download]
+        overwrite = "all"  # already checked
+    failed = []
+    expired = []
+    # more workers than pooled connections would open (and drop) extra connections
+    with ThreadPoolExecutor(max_workers=min(workers, POOL_MAXSIZE)) as executor:
+        futures = {executor.submit(download_file, session, paper_id, url, filename, overwrite): (idx, filename)
+                   for idx, paper_id, url, filename in tasks}
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Files processed", leave=False):
+                result = future.result()
+                if result is LINK_EXPIRED:
+                    expired.append(futures[future])
+                elif not result:  # download_file() already retried, so we give up on this file
+                    failed.append(futures[future])
+        except KeyboardInterrupt:
+            # otherwise leaving the with block would wait for all queued downloads
+            tqdm.write("Interrupted - waiting for running downloads to finish")
+            executor.shutdown(cancel_futures=True)
+            raise
+    return expired, failed  # lists of (submission index, filename)
 
 
 def print_status(track_id, filetypes, verbose=False):
     if len(filetypes) == 0:
         sys.exit()
-    missing = {}
+    missing = defaultdict(list)
+    columns, rows = read_camera_ready_csv(track_id)
+    paper_id_col = columns['Paper ID']
+    title_col = columns['Title']
+    # check once which fields are in the CSV instead of catching KeyErrors for every submission
+    field_index = []  # (description, column)
     for filetype in filetypes:
-        missing[filetype['description']] = []
-    fd = open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig')  # CSV has BOM
-    submissions = DictReader(fd)
-    for idx, submission in enumerate(submissions):
+        if filetype['pcs_field'] in columns:
+            field_index.append((filetype['description'], columns[filetype['pcs_field']]))
+        else:
+            print(f"   >... field {filetype['pcs_field']} not in CSV")
+    for idx, row in enumerate(rows):
+        paper_id = row[paper_id_col]
         if verbose:
-            print(f"[{idx}] Paper: {submission['Paper ID']} ({submission['Title']})")
-        for filetype in filetypes:
-            try:
-                doi = submission['DOI'].split("/")[-1]  # https://doi.org/10.1145/3491102.3501897 -> 3491102.3501897
-                paper_id = submission['Paper ID']
-                if len(submission[filetype['pcs_field']]) < 1:
-                    if verbose:
-                        print(f"   >... '{filetype['description']}' not submitted")
-                    missing[filetype['description']].append(paper_id)
-                else:
-                    if verbose:
-                        print(f"   >... '{filetype['description']}' submitted")
-            except KeyError:
-                print(f"   >... field {filetype['pcs_field']} not in CSV")
-    fd.close()
+            print(f"[{idx}] Paper: {paper_id} ({row[title_col]})")
+        for description, col in field_index:
+            if not row[col]:
+                if verbose:
+                    print(f"   >... '{description}' not submitted")
+                missing[description].append(paper_id)
+            elif verbose:
+                print(f"   >... '{description}' submitted")
     for filetype in filetypes:
         print(f"'{filetype['description']}' ({track_id}) still missing:")
         if len(missing[filetype['description']]) > 0:
@@ -227,7 +478,6 @@ def create_fields_file(track_id, fields_file):
     # if exists, exit
     print(f"Downloading spreadsheet for: {track_id}")
     FIELDS = "tracks,dl_flag,pcs_field,description,directory,suffix,mimetype,upload_to_dl,ready_field".split(',')
-    pcs_fields = None
     ft = {'pdf': {'folder': 'PDF', 'ext': '.pdf', 'mime': 'application/pdf', 'upload': 'no', 'ready_field': ''},
           'video': {'folder': 'VID', 'ext': '-video.mp4', 'mime': 'video/mp4', 'upload': 'yes', 'ready_field': ''},
           'subtitles': {'folder': 'VID', 'ext': '-subtitles.vtt', 'mime': 'text/vtt', 'upload': 'yes', 'ready_field': ''},
@@ -236,25 +486,43 @@ def create_fields_file(track_id, fields_file):
           'zip': {'folder': 'ZIP', 'ext': '.zip', 'mime': 'application/zip', 'upload': 'no', 'ready_field': ''},
           }
     fd = open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig')  # CSV has BOM
-    submissions = DictReader(fd)
-    for submission in submissions:
-        if not pcs_fields:
-            pcs_fields = {key: None for key in submission.keys()}
-        for field in pcs_fields.keys():
-            if submission[field].startswith("http"):   # we have an URL
-                if ".mp4" in submission[field]:
-                    pcs_fields[field] = "video"
-                if ".srt" in submission[field]:
-                    pcs_fields[field] = "subtitles"
-                if ".pdf" in submission[field]:
-                    pcs_fields[field] = "pdf"
-                if ".zip" in submission[field]:
-                    if "upplement" in field:
-                        pcs_fields[field] = "supplement"
-                    elif "ource" in field:
-                        pcs_fields[field] = "source"
-                    else:
-                        pcs_fields[field] = "zip"
+    submissions = csv.DictReader(fd)
+    pcs_fields = {key: None for key in submissions.fieldnames}
+    # fields that might still turn out to contain uploads - once we know the type of every
+    # upload field, we can stop reading the remaining submissions
+    unresolved = set(pcs_fields.keys())
+    for idx, submission in enumerate(submissions):
+        if idx >= GUESS_FIELDS_MAX_ROWS:  # e.g., columns with only unknown file types
+            break
+        for field in list(unresolved):
+            value = submission[field] or ''
+            if not value.startswith("http"):
+                if value:   # some other content, not an upload field
+                    unresolved.discard(field)
+                continue
+            # we have an URL. only look at the path, so that query strings (e.g., tokens) don't confuse us
+            url = urlparse(value)
+            if url.netloc in NON_UPLOAD_HOSTS:  # e.g., the DOI column
+                unresolved.discard(field)
+                continue
+            path = url.path.lower()
+            if path.endswith(".mp4"):
+                pcs_fields[field] = "video"
+            elif path.endswith(".srt"):
+                pcs_fields[field] = "subtitles"
+            elif path.endswith(".pdf"):
+                pcs_fields[field] = "pdf"
+            elif path.endswith(".zip"):
+                if "upplement" in field:
+                    pcs_fields[field] = "supplement"
+                elif "ource" in field:
+                    pcs_fields[field] = "source"
+                else:
+                    pcs_fields[field] = "zip"
+            if pcs_fields[field]:  # unknown file types (.mov, .docx, ...) - keep looking at later submissions
+                unresolved.discard(field)
+        if not unresolved:
+            break
     fd.close()
     field_file_lines = ["tracks,dl_flag,pcs_field,description,directory,suffix,mimetype,upload_to_dl,ready_field\n"]
     for field, fieldtype in pcs_fields.items():
@@ -269,14 +537,16 @@ def create_fields_file(track_id, fields_file):
 @click.command()
 @click.option('--user', prompt=True, help='PCS user (can also be set via environment variable PCS_USER)')
 @click.option("--password", prompt=True, help='PCS password (can also be set via environment variable PCS_PASSWORD)', hide_input=True)
-@click.option('--overwrite', type=click.Choice(['all', 'none', 'modified']), default='modified', help="all: always overwrite; none: never overwrite; modified: overwrite if file size has changed", show_default=True)
+@click.option('--overwrite', type=click.Choice(['all', 'none', 'modified']), default='modified', help="all: always overwrite; none: never overwrite; modified: overwrite if file size or ETag has changed (files downloaded or checked in the last 24 hours are not checked again, see --recheck)", show_default=True)
+@click.option('--recheck', is_flag=True, default=False, help='with --overwrite modified: ask the server about every file, even if it was downloaded or checked in the last 24 hours')
+@click.option('--workers', type=click.IntRange(min=1), default=4, help='number of files to download in parallel', show_default=True)
 @click.option('--start', 'start_index', default=0, help='start download at n-th line of CSV (good for resuming failed downloads')
 @click.option('--status', is_flag=True, default=False, help='only print status of submissions')
 @click.option('--tracks', is_flag=True, default=False, help='only print available tracks')
 @click.option('--guess_fields', is_flag=True, default=False, help='only try to automatically create a configuration file with fields for this track')
 @click.argument('track_id')
 @click.argument('dl_flags', nargs=-1)
-def download(track_id, dl_flags, overwrite, start_index, status, tracks, guess_fields, user, password):
+def download(track_id, dl_flags, overwrite, recheck, workers, start_index, status, tracks, guess_fields, user, password):
     """This script downloads a spreadsheet of camera-ready submissions for a given track from PCS.
         Afterwards, it optionally downloads all final PDFs, videos and zip files with supplementary 
         materials which are linked in the spreadsheet.
@@ -292,15 +562,16 @@ def download(track_id, dl_flags, overwrite, start_index, status, tracks, guess_f
 """
     if tracks:
         print("Checking which tracks you have access to...")
-        available_tracks = get_available_tracks(user, password, True)
+        available_tracks = get_available_tracks(login(user, password), True)
         if track_id not in available_tracks.keys():
             print(f"You don't seem to have 'chair' or 'pubchair' access to track '{track_id}'.")
         sys.exit(1)
 
+    session = login(user, password)  # reused for all requests in this run
     fields_file = f"{track_id}{FIELDS_FILE_SUFFIX}"
     if guess_fields:
         print(f"Downloading spreadsheet for: {track_id}")
-        get_camera_ready_csv(track_id, user, password)
+        get_camera_ready_csv(session, track_id, user, password)
         create_fields_file(track_id, fields_file)
         print("Field file generated - please check it!")
         sys.exit(0)
@@ -313,14 +584,11 @@ def download(track_id, dl_flags, overwrite, start_index, status, tracks, guess_f
         filetypes = all_filetypes
     else:
         # check for invalid dl_flags
-        acceptable_dl_flags = []
-        for ft in all_filetypes:
-            acceptable_dl_flags.append(ft['dl_flag'])
-        acceptable_dl_flags = set(acceptable_dl_flags)
-        accepted_dl_flags = []
+        acceptable_dl_flags = {ft['dl_flag'] for ft in all_filetypes}
+        accepted_dl_flags = set()
         for dl_flag in dl_flags:
             if dl_flag in acceptable_dl_flags:
-                accepted_dl_flags.append(dl_flag)
+                accepted_dl_flags.add(dl_flag)
             else:
                 print(f"Warning: '{dl_flag}' not configured in {fields_file} - ignored!")
         if len(dl_flags) > 0 and len(accepted_dl_flags) == 0:
@@ -328,13 +596,10 @@ def download(track_id, dl_flags, overwrite, start_index, status, tracks, guess_f
             print(f"Acceptable download flags are: {', '.join(acceptable_dl_flags)}")
             sys.exit(1)
 
-        filetypes = []
-        for ft in all_filetypes:
-            if ft['dl_flag'] in accepted_dl_flags:
-                filetypes.append(ft)
-        
+        filetypes = [ft for ft in all_filetypes if ft['dl_flag'] in accepted_dl_flags]
+
     print(f"Downloading spreadsheet for: {track_id}")
-    get_camera_ready_csv(track_id, user, password)
+    get_camera_ready_csv(session, track_id, user, password)
     if status:
         print_status(track_id, filetypes)
         return
@@ -343,13 +608,28 @@ def download(track_id, dl_flags, overwrite, start_index, status, tracks, guess_f
         return  # finished
 
     print(f"Downloading files for: {track_id}")
-    while True:  # reload camera-ready.csv on error
-        start_index = download_files(track_id, filetypes, start_index, overwrite=overwrite)
-        if start_index is None:   # finished
+    load_download_state(track_id)
+    failed = []
+    retry_files = None  # after reloading camera-ready.csv, only retry the files whose links expired
+    while True:  # reload camera-ready.csv if download links expired
+        expired, round_failed = download_files(session, track_id, filetypes, start_index, overwrite=overwrite, workers=workers,
+                                               max_age=0 if recheck else STATE_MAX_AGE, only_files=retry_files)
+        failed += round_failed
+        if not expired:   # finished
             break
-        else:
-            print(f"Restarting at submission #{start_index}")
-            get_camera_ready_csv(track_id, user, password)
+        expired_files = {filename for idx, filename in expired}
+        # links expire after some time, so expiring again is fine on long runs - as long as some files got through.
+        # if not even one file could be downloaded with a fresh CSV, don't keep hammering the server
+        if retry_files is not None and not retry_files - expired_files - {filename for idx, filename in round_failed}:
+            print("Download links still rejected after reloading camera_ready.csv - giving up on them")
+            failed += expired
+            break
+        retry_files = expired_files
+        print(f"Download links expired for {len(expired_files)} files - reloading camera_ready.csv")
+        get_camera_ready_csv(session, track_id, user, password, max_age=0)
+    if failed:
+        print(f"Failed to download: {', '.join(sorted(filename for idx, filename in failed))}")
+        sys.exit(1)
     print("Done!")
 
 